@@ -4,10 +4,12 @@
 import unittest
 
 from vast.vsquared import util, classes, zobov
+from vast.vsquared._zobov_cython import build_tris
 
 import os
 import copy
 import numpy as np
+from astropy.table import Table
 
 class TestV2(unittest.TestCase):
 
@@ -107,6 +109,17 @@ class TestV2(unittest.TestCase):
         self.assertEqual(len(zobov2.vrads), 14)
         self.assertEqual(len(zobov4.vrads), 49)
 
+        # Test void volumes, centers, and zone-to-void assignments
+        sorted_voids = [(TestV2.zobov, 8767219.498641418, [-147.70579371364175,-8.962648718466516,86.55625819469377], [18.727272727272727,18.727272727272727], [37,37]),
+                        (zobov1, 38497451.08878392, [-151.05583434805297,-14.725071046927658,88.62267675895991], [48.21212121212121,86.0], [0,0]),
+                        (zobov2, 28320013.24490852, [-139.5501860438976,-13.419100599822373,76.78494817379716], [9.343434343434344,13.0], [0,0]),
+                        (zobov4, 11648464.7299706, [-149.33008624559116,-10.614787030693641,94.16221207468554], [11.373737373737374,11.373737373737374], [50,50])]
+        for zv, vvol, vcen, zmean, zmiss in sorted_voids:
+            self.assertTrue(np.isclose(np.sum(4*np.pi/3*zv.vrads**3), vvol))
+            self.assertTrue(np.isclose(np.mean(zv.vcens, axis=0), vcen).all())
+            self.assertTrue(np.isclose(np.mean(zv.zvoid, axis=0), zmean).all())
+            self.assertTrue((np.sum(np.array(zv.zvoid)==-1, axis=0) == zmiss).all())
+
         # Save voids.
         self.assertTrue(hasattr(TestV2.zobov, 'vrads')) # after sortVoids
 
@@ -118,10 +131,99 @@ class TestV2(unittest.TestCase):
         TestV2.zobov.saveZones()
         self.assertTrue(os.path.exists('TEST_galzones.dat'))
 
+        # Test galaxy zones, depths, and edge and out flags
+        galzones = Table.read('TEST_galzones.dat', format='ascii.commented_header')
+        self.assertTrue(np.isclose(np.mean(galzones['zone']), 22.9551))
+        self.assertTrue(np.isclose(np.mean(galzones['depth']), 1.8582))
+        self.assertTrue(np.isclose(np.mean(galzones['edge']), 0.1721))
+        self.assertTrue(np.isclose(np.mean(galzones['out']), 0.18))
+
+    def test_zobov_5_build_tris(self):
+        """Test triangulation of the zone boundary polygons
+        """
+        rng = np.random.default_rng(42)
+        galc = rng.random((6,3))
+        verc = rng.random((10,3))
+
+        # Zone 0 has a square and a triangle, zone 1 a pentagon, zone 2 a square
+        zverts = [[[0,1,2,3],[4,5,6]], [[5,6,7,8,9]], [[9,2,4,0]]]
+        znorms = [[[0,1],[0,2]], [[3,4]], [[5,0]]]
+        zgroups = [np.array([0,1]), np.array([2])]
+
+        tri1, tri2, tri3, norm, vid = build_tris(zverts, znorms, galc, verc, zgroups)
+
+        # Fan each polygon around its first vertex
+        t1, t2, t3, n1, v1 = [], [], [], [], []
+        for k,v in enumerate(zgroups):
+            for z in v:
+                for i in range(len(znorms[z])):
+                    p = znorms[z][i]
+                    n = galc[p[1]] - galc[p[0]]
+                    n = n/np.sqrt(np.sum(n**2.))
+                    polids = zverts[z][i]
+                    for j in range(1,len(polids)-1):
+                        t1.append(verc[polids[0]])
+                        t2.append(verc[polids[j]])
+                        t3.append(verc[polids[j+1]])
+                        n1.append(n)
+                        v1.append(k)
+
+        self.assertEqual(len(vid), 8)
+        self.assertTrue(np.isclose(tri1, t1).all())
+        self.assertTrue(np.isclose(tri2, t2).all())
+        self.assertTrue(np.isclose(tri3, t3).all())
+        self.assertTrue(np.isclose(norm, n1).all())
+        self.assertTrue((vid == v1).all())
+
+    def test_zobov_5_vaxes(self):
+        """Test ZOBOV void ellipsoid axes
+        """
+        ctlg  = TestV2.zobov.catalog
+        cutco = ctlg.coord[ctlg.nnls==np.arange(len(ctlg.nnls))]
+        zvoid = np.array(TestV2.zobov.zvoid)
+
+        for i in range(len(TestV2.zobov.vrads)):
+            # The voids of the test catalog share no zones, so the zones of
+            # void i are those whose largest void is i
+            cells = np.concatenate([TestV2.zobov.zones.zcell[z] for z in np.flatnonzero(zvoid[:,1]==i)])
+            sma = util.getSMA(TestV2.zobov.vrads[i], cutco[cells])
+            vax = TestV2.zobov.vaxes[i]
+
+            # Compare the axes ordered by length, up to sign
+            i1 = np.argsort(np.linalg.norm(sma, axis=1))
+            i2 = np.argsort(np.linalg.norm(vax, axis=1))
+            self.assertTrue(np.isclose(np.abs(sma[i1]), np.abs(vax[i2])).all())
+
+    def test_zobov_6_previz(self):
+        """Test ZOBOV visualization output
+        """
+        zobov_viz = zobov.Zobov(TestV2.inifile, save_intermediate=False, visualize=True)
+        zobov_viz.sortVoids()
+        zobov_viz.preViz()
+        self.assertTrue(os.path.exists('TEST_triangles.dat'))
+        self.assertTrue(os.path.exists('TEST_galviz.dat'))
+
+        # Test triangles
+        tris = Table.read('TEST_triangles.dat', format='ascii.commented_header')
+        self.assertEqual(len(tris), 13184)
+        self.assertTrue(np.isclose(np.mean(tris['void_id']), 2.738622572815534))
+        self.assertTrue(np.isclose(np.mean(tris['n_x']), 0.02429115275736726))
+        self.assertTrue(np.isclose(np.mean(tris['p1_x']), -150.21432264348155))
+        self.assertTrue(np.isclose(np.mean(tris['p2_y']), -17.08170115572422))
+        self.assertTrue(np.isclose(np.mean(tris['p3_z']), 111.40096101062534))
+
+        # Test galaxy-to-void assignments
+        g2vT = Table.read('TEST_galviz.dat', format='ascii.commented_header')
+        self.assertEqual(np.sum(g2vT['g2v']!=-1), 578)
+        self.assertTrue(np.isclose(np.mean(g2vT['g2v']), -0.7967))
+        self.assertEqual(np.sum(g2vT['g2v2']!=-1), 129)
+        self.assertTrue(np.isclose(np.mean(g2vT['g2v2']), -0.9203))
+
     def tearDown(self):
         """Delete files produced for the unit tests.
         """
-        files = [ 'TEST_zobovoids.dat', 'TEST_zonevoids.dat', 'TEST_galzones.dat' ]
+        files = [ 'TEST_zobovoids.dat', 'TEST_zonevoids.dat', 'TEST_galzones.dat',
+                  'TEST_triangles.dat', 'TEST_galviz.dat' ]
         for f in files:
             if os.path.exists(f):
                 os.remove(f)
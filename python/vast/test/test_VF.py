@@ -8,6 +8,7 @@ from astropy.table import Table, setdiff, vstack
 
 from vast.voidfinder.constants import c
 from vast.voidfinder import find_voids, filter_galaxies
+from vast.voidfinder.hole_combine import combine_holes
 from vast.voidfinder.multizmask import generate_mask
 from vast.voidfinder.preprocessing import file_preprocess
 
@@ -186,6 +187,33 @@ class TestVoidFinder(unittest.TestCase):
 #                                 format='ascii.commented_header')
 #        self.assertEqual(len(setdiff(holes_truth, f_holes)), 0)
 
+    def test_5_combine_holes(self):
+        """Combine a small set of holes into voids
+        """
+        spheres = Table()
+        spheres['x'] = [0., 1., 0., 30., 55., -18., 72., 0.]
+        spheres['y'] = [0., 0., -18., 0., 0., 0., 0., 100.]
+        spheres['z'] = np.zeros(8)
+        spheres['radius'] = [20., 11., 15., 16., 18., 9., 8., 7.]
+        spheres.sort('radius')
+        spheres.reverse()
+
+        f_maximals, f_holes = combine_holes(spheres)
+
+        # Check maximal spheres
+        self.assertTrue(np.isclose(f_maximals['x'], [0., 55.]).all())
+        self.assertTrue(np.isclose(f_maximals['radius'], [20., 18.]).all())
+        self.assertTrue((f_maximals['flag'] == [1, 2]).all())
+
+        # Check holes
+        self.assertTrue(np.isclose(f_holes['x'], [0., 55., -18., 72.]).all())
+        self.assertTrue(np.isclose(f_holes['radius'], [20., 18., 9., 8.]).all())
+        self.assertTrue((f_holes['flag'] == [1, 2, 1, 2]).all())
+
+        # Holes must be sorted by radius in descending order
+        with self.assertRaises(ValueError):
+            combine_holes(spheres[::-1])
+
     def tearDown(self):
         """Delete files produced for the unit tests.
         """
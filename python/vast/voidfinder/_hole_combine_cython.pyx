@@ -111,7 +111,7 @@ cpdef np.ndarray remove_duplicates_2(DTYPE_F64_t[:,:] x_y_z_r_array,
             
             last_idx = idx
             
-    return out_index.astype(np.bool)
+    return out_index.astype(bool)
 
 
 
@@ -171,6 +171,99 @@ cdef DTYPE_F64_t spherical_cap_volume(DTYPE_F64_t radius,
 
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline DTYPE_F64_t pair_overlap_volume(DTYPE_F64_t radius_1, 
+                                            DTYPE_F64_t radius_2, 
+                                            DTYPE_F64_t separation):
+    '''Calculate the volume of intersection of two overlapping spheres'''
+    
+    return spherical_cap_volume(radius_1, cap_height(radius_1, radius_2, separation)) \
+           + spherical_cap_volume(radius_2, cap_height(radius_2, radius_1, separation))
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef np.ndarray overlap_volume(DTYPE_F64_t[:] radius_1, 
+                                DTYPE_F64_t[:] radius_2, 
+                                DTYPE_F64_t[:] separation):
+    """
+    Description
+    ===========
+    
+    Calculate the volume of intersection of pairs of overlapping spheres as 
+    the sum of the two spherical caps.  The cap heights are computed and 
+    consumed element by element, so no intermediate arrays are created.
+    
+    
+    Parameters
+    ==========
+    
+    radius_1 : ndarray of shape (N,)
+        radii of the first sphere of each pair
+        
+    radius_2 : ndarray of shape (N,)
+        radii of the second sphere of each pair
+        
+    separation : ndarray of shape (N,)
+        distance between the centers of the two spheres of each pair
+        
+        
+    Returns
+    =======
+    
+    out_volume : ndarray of shape (N,)
+        overlap volume of each pair.  Only meaningful for pairs which 
+        actually overlap; a separation of 0 gives inf or nan.
+    """
+    
+    cdef ITYPE_t idx
+    
+    cdef ITYPE_t num_pairs = separation.shape[0]
+    
+    out_volume = np.empty(num_pairs, dtype=np.float64)
+    
+    cdef DTYPE_F64_t[:] out_volume_memview = out_volume
+    
+    for idx in range(num_pairs):
+        
+        out_volume_memview[idx] = pair_overlap_volume(radius_1[idx], radius_2[idx], separation[idx])
+        
+    return out_volume
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef np.ndarray overlap_volume_single(DTYPE_F64_t radius_1, 
+                                       DTYPE_F64_t[:] radius_2, 
+                                       DTYPE_F64_t[:] separation):
+    """
+    Same as overlap_volume, but for one sphere of radius radius_1 against 
+    each of the N spheres in radius_2, so that the caller does not need to 
+    broadcast radius_1 into an array.
+    """
+    
+    cdef ITYPE_t idx
+    
+    cdef ITYPE_t num_pairs = separation.shape[0]
+    
+    out_volume = np.empty(num_pairs, dtype=np.float64)
+    
+    cdef DTYPE_F64_t[:] out_volume_memview = out_volume
+    
+    for idx in range(num_pairs):
+        
+        out_volume_memview[idx] = pair_overlap_volume(radius_1, radius_2[idx], separation[idx])
+        
+    return out_volume
+
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -2,7 +2,7 @@ from astropy.table import Table
 
 import numpy as np
 
-from .table_functions import to_array,to_vector
+from sklearn import neighbors
 
 import time
 
@@ -10,10 +10,14 @@ import time
 #warnings.simplefilter('error')
 
 from ._hole_combine_cython import remove_duplicates_2, \
-                                  find_maximals_2, \
                                   find_maximals_3, \
-                                  find_holes_2, \
-                                  join_holes_to_maximals
+                                  join_holes_to_maximals, \
+                                  overlap_volume, \
+                                  overlap_volume_single
+
+
+# Volume of a sphere is FOUR_PI_OVER_THREE*radius**3
+FOUR_PI_OVER_THREE = 4.0*np.pi/3.0
 
 
 ################################################################################
@@ -32,39 +36,44 @@ def spherical_cap_volume(radius, height):
 ################################################################################
 
 
-def cap_height(R, r, d):
-    '''Calculate the height of a spherical cap.
+def sphere_arrays(spheres_table):
+    '''
+    Extract the centers and radii of a table of spheres as plain numpy arrays, 
+    so that hot loops index numpy memory instead of astropy Columns and Rows.
 
-    Parameters
-    __________
 
-    R : radius of sphere
+    Parameters:
+    ===========
 
-    r : radius of other sphere
+    spheres_table : astropy table of length N
+        Table of spheres.  Required columns: x, y, z, radius
 
-    d : distance between sphere centers
 
+    Returns:
+    ========
 
-    Output
-    ______
+    coords : numpy array of shape (N,3)
+        C-contiguous float64 array of the sphere centers
 
-    h : height of cap
+    radii : numpy array of shape (N,)
+        float64 array of the sphere radii
     '''
-    '''for elem in d:
-        if np.isnan(elem) or elem == 0:
-            print(d)
-            print(':(')'''
-    h = (r - R + d)*(r + R - d)/(2*d)
-    
 
-    return h
+    coords = np.ascontiguousarray(np.column_stack([spheres_table['x'], 
+                                                   spheres_table['y'], 
+                                                   spheres_table['z']]), 
+                                  dtype=np.float64)
+
+    radii = np.asarray(spheres_table['radius'], dtype=np.float64)
+
+    return coords, radii
 
 
 ################################################################################
 ################################################################################
 
 
-def combine_holes(spheres_table, frac=0.1):
+def combine_holes(spheres_table, frac=0.1, verbose=0):
     '''
     Combines the potential void spheres into voids.
 
@@ -73,13 +82,16 @@ def combine_holes(spheres_table, frac=0.1):
     ===========
 
     spheres_table : astropy table of length N
-        Table of holes found, sorted by radius.  Required columns: radius, x, y, 
-        z (in units of Mpc/h)
+        Table of holes found, sorted by radius in descending order.  Required 
+        columns: radius, x, y, z (in units of Mpc/h)
 
     frac : float
         Fraction of hole volume.  If a hole overlaps a maximal sphere by more 
         than this fraction, it is not part of a unique void.  Default is 10%.
 
+    verbose : int
+        values greater than zero indicate to print timing output
+
 
     Returns:
     ========
@@ -95,7 +107,11 @@ def combine_holes(spheres_table, frac=0.1):
     '''
 
 
-    print('Starting hole combine', flush=True)
+    if np.any(np.diff(spheres_table['radius']) > 0):
+        raise ValueError("spheres_table must be sorted by radius in descending order")
+
+    if verbose > 0:
+        print('Starting hole combine', flush=True)
 
     time_start = time.time()
 
@@ -105,7 +121,8 @@ def combine_holes(spheres_table, frac=0.1):
     unique_spheres_table = remove_duplicates(spheres_table)
     ############################################################################
 
-    print("Remove duplicate spheres:", time.time() - time_start, flush=True)
+    if verbose > 0:
+        print("Remove duplicate spheres:", time.time() - time_start, flush=True)
 
 
     ############################################################################
@@ -115,13 +132,8 @@ def combine_holes(spheres_table, frac=0.1):
     
     maximal_spheres_table, maximal_spheres_indices = find_maximals(unique_spheres_table, frac)
 
-    print("Find maximal holes:", time.time() - time_start, flush=True)
-
-    # Array of coordinates for maximal spheres
-    maximal_spheres_coordinates = to_array(maximal_spheres_table)
-
-    # Array of radii for maximal spheres
-    maximal_spheres_radii = np.array(maximal_spheres_table['radius'])
+    if verbose > 0:
+        print("Find maximal holes:", time.time() - time_start, flush=True)
     ############################################################################
 
 
@@ -133,7 +145,8 @@ def combine_holes(spheres_table, frac=0.1):
 
     holes_table = find_holes(unique_spheres_table, maximal_spheres_table, maximal_spheres_indices)
 
-    print("Merge holes into voids:", time.time() - time_start, flush=True)
+    if verbose > 0:
+        print("Merge holes into voids:", time.time() - time_start, flush=True)
     ############################################################################
 
     return maximal_spheres_table, holes_table
@@ -373,8 +386,8 @@ def find_maximals(spheres_table, frac):
     ===========
 
     spheres_table : astropy table of length N
-        Table of holes found, sorted by radius.  Required columns: radius, x, y, 
-        z (in units of Mpc/h)
+        Table of holes found, sorted by radius in descending order.  Required 
+        columns: radius, x, y, z (in units of Mpc/h)
 
     frac : float
         Fraction of hole volume.  If a hole overlaps a maximal sphere by more 
@@ -395,49 +408,36 @@ def find_maximals(spheres_table, frac):
 
 
 
-    array = np.array([spheres_table['x'], 
-                      spheres_table['y'], 
-                      spheres_table['z'], 
-                      spheres_table['radius']])
-    x_y_z_r_array = array.T
-    
-    #time_1 = time.time()
-    
-    maximal_spheres_indices_2 = find_maximals_2(x_y_z_r_array, frac, 10.0)
-    
-    #print("New FIND_MAXIMALS, TIME_1: ", time.time() - time_1, flush=True)
+    # Coordinates and radii of all spheres, extracted once so that the loop 
+    # below never goes through the astropy table
+    coords, radii = sphere_arrays(spheres_table)
 
-    #time_2 = time.time()
-
-    large_spheres_indices = np.nonzero(spheres_table['radius'] > 10)[0]
-    
-    all_sphere_coords = to_array(spheres_table)
-    all_sphere_radii = spheres_table['radius'].data
-    
-    maximal_spheres_coordinates = np.empty((large_spheres_indices.shape[0], 3))
-    maximal_spheres_radii = np.empty(large_spheres_indices.shape[0])
+    # Maximum volume of each sphere which may overlap a maximal sphere
+    frac_volumes = frac*FOUR_PI_OVER_THREE*radii**3
 
+    large_spheres_indices = np.nonzero(radii > 10)[0]
 
-    maximal_spheres_coordinates[0,:] = to_vector(spheres_table[0])
-    maximal_spheres_radii[0] = spheres_table['radius'][0]
-    
-    out_idx = 1
+    N_large_spheres = large_spheres_indices.shape[0]
 
+    # Preallocated buffers of the maximal sphere coordinates and radii; only the 
+    # first n_max rows are valid
+    max_xyz = np.empty((N_large_spheres, 3))
+    max_r = np.empty(N_large_spheres)
 
     # The largest hole is a void
-    N_voids = 1
+    max_xyz[0] = coords[0]
+    max_r[0] = radii[0]
+    n_max = 1
+
     maximal_spheres_indices = [0]
 
     for i in large_spheres_indices[1:]:
 
         # Coordinates of sphere i
-        #sphere_i_coordinates = to_vector(spheres_table[i])
+        sphere_i_coordinates = coords[i]
 
         # Radius of sphere i
-        #sphere_i_radius = spheres_table['radius'][i]
-        
-        sphere_i_coordinates = all_sphere_coords[i,:]
-        sphere_i_radius = all_sphere_radii[i]
+        sphere_i_radius = radii[i]
 
         ########################################################################
         #
@@ -445,21 +445,24 @@ def find_maximals(spheres_table, frac):
         #
         ########################################################################
 
-        # Array of coordinates for previously identified maximal spheres
-        #maximal_spheres_coordinates = to_array(spheres_table[maximal_spheres_indices])
+        # Radii of the previously identified maximal spheres
+        maximal_radii = max_r[:n_max]
 
-        # Array of radii for previously identified maximal spheres
-        #maximal_spheres_radii = np.array(spheres_table['radius'][maximal_spheres_indices])
-
-        # Distance between sphere i's center and the centers of the other maximal spheres
-        separation = np.linalg.norm((maximal_spheres_coordinates[0:out_idx,:] - sphere_i_coordinates), axis=1)
+        # Squared distance between sphere i's center and the centers of the 
+        # other maximal spheres.  Since spheres_table is sorted by radius, every 
+        # maximal sphere found so far is at least as large as sphere i, so both 
+        # sides of the comparisons below are non-negative and they can be made 
+        # on squared distances.
+        d = max_xyz[:n_max] - sphere_i_coordinates
+        separation2 = np.einsum('ij,ij->i', d, d)
 
         ########################################################################
         # Does sphere i live completely inside another maximal sphere?
         #-----------------------------------------------------------------------
-        if any((maximal_spheres_radii[0:out_idx] - sphere_i_radius) >= separation):
+        radius_difference = maximal_radii - sphere_i_radius
+
+        if np.any(radius_difference*radius_difference >= separation2):
             # Sphere i is completely inside another sphere --- sphere i is not a maximal sphere
-            #print('Sphere i is completely inside another sphere')
             continue
         ########################################################################
 
@@ -468,64 +471,45 @@ def find_maximals(spheres_table, frac):
         # Does sphere i overlap by less than x% with another maximal sphere?
         #-----------------------------------------------------------------------
         # First - determine which maximal spheres overlap with sphere i
-        overlap_boolean =  separation <= (sphere_i_radius + maximal_spheres_radii[0:out_idx])
+        radius_sum = sphere_i_radius + maximal_radii
+
+        overlap_boolean =  separation2 <= radius_sum*radius_sum
 
-        if any(overlap_boolean):
+        if np.any(overlap_boolean):
             # Sphere i overlaps at least one maximal sphere by some amount.
             # Check to see by how much.
 
-            # Heights of the spherical caps
-            height_i = cap_height(sphere_i_radius, 
-                                  maximal_spheres_radii[0:out_idx][overlap_boolean], 
-                                  separation[overlap_boolean])
-
-            height_maximal = cap_height(maximal_spheres_radii[0:out_idx][overlap_boolean], 
-                                        sphere_i_radius, separation[overlap_boolean])
+            overlap_radii = maximal_radii[overlap_boolean]
 
             # Overlap volume
-            overlap_volume = spherical_cap_volume(sphere_i_radius, height_i) \
-                             + spherical_cap_volume(maximal_spheres_radii[0:out_idx][overlap_boolean], height_maximal)
-
-            # Volume of sphere i
-            volume_i = (4./3.)*np.pi*sphere_i_radius**3
-
-            if all(overlap_volume <= frac*volume_i):
-                # Sphere i does not overlap by more than x% with any of the other known maximal spheres.
-                # Sphere i is therefore a maximal sphere.
-                #print('Overlap by less than x%: maximal sphere')
-                N_voids += 1
-                maximal_spheres_indices.append(i)
-                maximal_spheres_coordinates[out_idx,:] = sphere_i_coordinates
-                maximal_spheres_radii[out_idx] = sphere_i_radius
-                out_idx += 1
-
-        else:
-            # No overlap!  Sphere i is a maximal sphere
-            #print('No overlap: maximal sphere')
-            N_voids += 1
-            maximal_spheres_indices.append(i)
-            maximal_spheres_coordinates[out_idx,:] = sphere_i_coordinates
-            maximal_spheres_radii[out_idx] = sphere_i_radius
-            out_idx += 1
+            overlap_volumes = overlap_volume_single(sphere_i_radius, 
+                                                    overlap_radii, 
+                                                    np.sqrt(separation2[overlap_boolean]))
+
+            if not np.max(overlap_volumes) <= frac_volumes[i]:
+                # Sphere i overlaps by more than x% with one of the other known 
+                # maximal spheres.
+                continue
+
+        # Either there is no overlap, or sphere i does not overlap by more than 
+        # x% with any of the other known maximal spheres.  Sphere i is therefore 
+        # a maximal sphere.
+        maximal_spheres_indices.append(i)
+        max_xyz[n_max] = sphere_i_coordinates
+        max_r[n_max] = sphere_i_radius
+        n_max += 1
         ########################################################################
 
 
     # Extract table of maximal spheres
-    #maximal_spheres_table = spheres_table[maximal_spheres_indices]
-    maximal_spheres_table = Table(maximal_spheres_coordinates[0:out_idx], names=['x','y','z'])
-    maximal_spheres_table['radius'] = maximal_spheres_radii[0:out_idx]
+    maximal_spheres_table = Table(max_xyz[:n_max], names=['x','y','z'])
+    maximal_spheres_table['radius'] = max_r[:n_max]
 
     # Add void flag identifier to maximal spheres
-    maximal_spheres_table['flag'] = np.arange(N_voids) + 1
+    maximal_spheres_table['flag'] = np.arange(n_max) + 1
 
     # Convert maximal_spheres_indices to numpy array of type int
     maximal_spheres_indices = np.array(maximal_spheres_indices, dtype=int)
-    
-    #print("New FIND_MAXIMALS, TIME_2: ", time.time() - time_2)
-    
-    #print(maximal_spheres_indices_2[0:10])
-    #print(maximal_spheres_indices[0:10])
-    #print(np.all(maximal_spheres_indices==maximal_spheres_indices_2))
 
     return maximal_spheres_table, maximal_spheres_indices
 
@@ -569,157 +553,125 @@ def find_holes(spheres_table, maximal_spheres_table, maximal_spheres_indices):
     '''
 
 
-    array = np.array([spheres_table['x'], 
-                      spheres_table['y'], 
-                      spheres_table['z'], 
-                      spheres_table['radius']])
-    x_y_z_r_array = array.T
-    
-    #time_1 = time.time()
+    # Number of holes
+    N_spheres = len(spheres_table)
 
-    out = find_holes_2(x_y_z_r_array, maximal_spheres_indices, 0.5)
-    
-    new_holes_index = out[:,0]
-    new_flag_col = out[:,1]
-    
-    #print("NEW FIND HOLES TIME: ", time.time() - time_1)
+    # Coordinates and radii of all spheres
+    coords, radii = sphere_arrays(spheres_table)
 
+    # Coordinates and radii of maximal spheres
+    maximal_spheres_coordinates, maximal_spheres_radii = sphere_arrays(maximal_spheres_table)
 
+    # Void flag identifiers of maximal spheres
+    maximal_spheres_flags = np.array(maximal_spheres_table['flag'])
 
-    #time_2 = time.time()
+    N_voids = len(maximal_spheres_radii)
 
 
-    # Initialize void flag identifier
-    spheres_table['flag'] = -1
+    ############################################################################
+    # Every maximal sphere is a hole in its own void
+    #---------------------------------------------------------------------------
+    is_maximal = np.zeros(N_spheres, dtype=bool)
+    is_maximal[maximal_spheres_indices] = True
 
-    # Number of holes
-    N_spheres = len(spheres_table)
+    holes_boolean = is_maximal.copy()
 
-    # Initialize index array for holes
-    holes_indices = []
+    flag = np.full(N_spheres, -1, dtype=int)
+    flag[maximal_spheres_indices] = maximal_spheres_flags
+    ############################################################################
 
-    # Number of spheres which are assigned to a void (holes)
-    N_holes = 0
 
-    # Coordinates of maximal spheres
-    maximal_spheres_coordinates = to_array(maximal_spheres_table)
+    ############################################################################
+    #
+    # COMPARE ALL OTHER SPHERES AGAINST MAXIMAL SPHERES
+    #
+    # Only maximal spheres closer than the sphere's radius plus the largest 
+    # maximal radius can contain or overlap the sphere, so a KDTree of the 
+    # maximal sphere centers is used to find those candidates.  The candidate 
+    # (sphere, maximal) pairs are then tested all at once.
+    ############################################################################
+    candidate_indices = np.flatnonzero(~is_maximal)
 
-    # Radii of maximal spheres
-    maximal_spheres_radii = np.array(maximal_spheres_table['radius'])
+    N_candidates = len(candidate_indices)
 
-    maximal_indices = np.arange(len(maximal_spheres_indices))
-    
-    
-    all_sphere_coords = to_array(spheres_table)
-    all_sphere_radii = spheres_table['radius'].data
-    
-    
-    
-    
-    maximal_sphere_index = {}
-    
-    for idx,element in enumerate(maximal_spheres_indices):
-        
-        maximal_sphere_index[element] = idx
-    
-    
+    if N_candidates > 0 and N_voids > 0:
 
-    for i in range(N_spheres):
+        candidate_radii = radii[candidate_indices]
 
-        ########################################################################
-        # First - check if i is a maximal sphere
-        #-----------------------------------------------------------------------
-        if i in maximal_sphere_index:
-            N_holes += 1
-            holes_indices.append(i)
-            #spheres_table['flag'][i] = maximal_spheres_table['flag'][maximal_spheres_indices == i]
-            spheres_table['flag'][i] = maximal_spheres_table['flag'][maximal_sphere_index[i]]
-            #print('sphere i is a maximal sphere')
-            continue
-        ########################################################################
+        # Half the volume of each sphere
+        half_volumes = 0.5*FOUR_PI_OVER_THREE*candidate_radii**3
 
+        maximal_tree = neighbors.KDTree(maximal_spheres_coordinates)
 
-        # Coordinates of sphere i
-        #sphere_i_coordinates = to_vector(spheres_table[i])
-        sphere_i_coordinates = all_sphere_coords[i,:]
+        neighbor_indices, neighbor_separations = maximal_tree.query_radius(
+                coords[candidate_indices], 
+                candidate_radii + np.max(maximal_spheres_radii), 
+                return_distance=True)
 
-        # Radius of sphere i
-        #sphere_i_radius = spheres_table['radius'][i]
-        sphere_i_radius = all_sphere_radii[i]
+        N_neighbors = np.fromiter(map(len, neighbor_indices), 
+                                  dtype=np.intp, 
+                                  count=N_candidates)
 
+        # Flatten the candidates into (sphere, maximal) pairs
+        pair_sphere = np.repeat(np.arange(N_candidates), N_neighbors)
+        pair_maximal = np.concatenate(neighbor_indices)
 
-        ########################################################################
-        #
-        # COMPARE AGAINST MAXIMAL SPHERES
-        #
-        ########################################################################
+        # Distance between each sphere's center and the center of each 
+        # candidate maximal sphere
+        separation = np.concatenate(neighbor_separations)
+
+        sphere_radii = candidate_radii[pair_sphere]
+        maximal_radii = maximal_spheres_radii[pair_maximal]
+
+        # The pairs are grouped by sphere, so the pairs of each sphere form a 
+        # contiguous segment starting at its offset.  Spheres without any 
+        # candidates are left out of the segment reductions below, since 
+        # reduceat cannot represent empty segments.
+        has_neighbors = N_neighbors > 0
 
-        # Distance between sphere i's center and the centers of the maximal spheres
-        separation = np.linalg.norm((maximal_spheres_coordinates - sphere_i_coordinates), axis=1)
-        '''
-        if any(separation == 0):
-            print(i)
-            print(np.where(separation==0))
-            print(maximal_spheres_coordinates[np.where(separation==0)])
-            print(sphere_i_coordinates)
-        '''
+        offsets = (np.cumsum(N_neighbors) - N_neighbors)[has_neighbors]
 
         ########################################################################
-        # Does sphere i live completely inside a maximal sphere?
+        # Does the sphere live completely inside a maximal sphere?
         #-----------------------------------------------------------------------
-        if any((maximal_spheres_radii - sphere_i_radius) >= separation):
-            # Sphere i is completely inside another sphere --- sphere i should not be saved
-            #print('Sphere completely inside another sphere', sphere_i_radius)
-            continue
+        inside_boolean = np.zeros(N_candidates, dtype=bool)
+
+        inside_boolean[has_neighbors] = np.logical_or.reduceat((maximal_radii - sphere_radii) >= separation, 
+                                                               offsets)
         ########################################################################
 
 
         ########################################################################
-        # Does sphere i overlap by more than 50% with a maximal sphere?
+        # Does the sphere overlap by more than 50% with a maximal sphere?
         #-----------------------------------------------------------------------
-        # First - determine which maximal spheres sphere i overlaps with
-        overlap_boolean =  separation <= (sphere_i_radius + maximal_spheres_radii)
-        
-        if any(overlap_boolean):
-            # Sphere i overlaps at least one maximal sphere by some amount.
-            # Check to see by how much.
+        # First - determine which maximal spheres each sphere overlaps with
+        overlap_boolean = separation <= (sphere_radii + maximal_radii)
 
-            maximal_overlap_indices = maximal_indices[overlap_boolean]
+        # Overlap volume.  This is only meaningful where the spheres overlap, 
+        # and is masked out by overlap_boolean below.
+        overlap_volumes = overlap_volume(sphere_radii, maximal_radii, separation)
 
-            # Heights of the spherical caps
-            height_i = cap_height(sphere_i_radius, 
-                                  maximal_spheres_radii[overlap_boolean], 
-                                  separation[overlap_boolean])
-            
-            height_maximal = cap_height(maximal_spheres_radii[overlap_boolean], 
-                                        sphere_i_radius, 
-                                        separation[overlap_boolean])
+        # Does the sphere overlap by at least 50% of its volume with a maximal 
+        # sphere?
+        overlap2_boolean = overlap_boolean & (overlap_volumes > half_volumes[pair_sphere])
 
-            # Overlap volume
-            overlap_volume = spherical_cap_volume(sphere_i_radius, height_i) \
-                             + spherical_cap_volume(maximal_spheres_radii[overlap_boolean], height_maximal)
+        # A sphere which overlaps by more than 50% with exactly one maximal 
+        # sphere is a hole in that void
+        N_overlap2 = np.zeros(N_candidates, dtype=np.intp)
 
-            # Volume of sphere i
-            volume_i = (4./3.)*np.pi*sphere_i_radius**3
+        N_overlap2[has_neighbors] = np.add.reduceat(overlap2_boolean, 
+                                                    offsets, 
+                                                    dtype=np.intp)
 
-            # Does sphere i overlap by at least 50% of its volume with a maximal sphere?
-            overlap2_boolean = overlap_volume > 0.5*volume_i
-            
-            if sum(overlap2_boolean) == 1:
-                # Sphere i overlaps by more than 50% with one maximal sphere
-                # Sphere i is therefore a hole in that void
+        hole_boolean = ~inside_boolean & (N_overlap2 == 1)
 
-                #print('Hole inside void', sphere_i_radius)
+        hole_pairs = overlap2_boolean & hole_boolean[pair_sphere]
 
-                N_holes += 1
+        hole_indices = candidate_indices[pair_sphere[hole_pairs]]
 
-                holes_indices.append(i)
+        holes_boolean[hole_indices] = True
 
-                spheres_table['flag'][i] = maximal_spheres_table['flag'][maximal_overlap_indices[overlap2_boolean]]
-            '''
-            else:
-                print('Hole overlaps void, but not part of one', sphere_i_radius)
-            '''
+        flag[hole_indices] = maximal_spheres_flags[pair_maximal[hole_pairs]]
         ########################################################################
 
 
@@ -729,29 +681,10 @@ def find_holes(spheres_table, maximal_spheres_table, maximal_spheres_indices):
     #
     ############################################################################
 
-    holes_table = spheres_table[holes_indices]
-    
-    #print("OLD FIND HOLES TIME: ", time.time() - time_2)
-    #print(new_holes_index[0:10])
-    #print(np.array(holes_indices)[0:10])
-    
-    matches = new_holes_index==np.array(holes_indices)
-    #print(np.array(holes_indices).shape[0])
-    #print(new_holes_index.shape[0])
-    #print(np.sum(matches))
-    
-    n_match = 0
-    for elem in np.array(holes_indices):
-        
-        if elem in new_holes_index:
-            n_match += 1
-            
-    #print("N_match: ", n_match)
-    
-    
-    #print(match_pct)
-    #print(np.all(new_holes_index==np.array(holes_indices)))
-    
+    spheres_table['flag'] = flag
+
+    holes_table = spheres_table[np.flatnonzero(holes_boolean)]
+
 
     return holes_table
 
@@ -813,7 +746,7 @@ if __name__ == '__main__':
     fake_table.sort('radius')
     fake_table.reverse()
 
-    maximal_spheres_table, myvoids_table = combine_holes(fake_table, 0.1)
+    maximal_spheres_table, myvoids_table = combine_holes(fake_table, 0.1, verbose=1)
 
     maximal_spheres_table.pprint()
     myvoids_table.pprint()
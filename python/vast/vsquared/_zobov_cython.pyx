@@ -0,0 +1,160 @@
+#cython: language_level=3
+
+cimport cython
+import numpy as np
+cimport numpy as np
+np.import_array()  # required in order to use C-API
+
+
+from ..voidfinder.typedefs cimport DTYPE_F64_t, \
+                                   ITYPE_t, \
+                                   DTYPE_INT64_t
+
+from libc.math cimport sqrt
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef tuple build_tris(list zverts,
+                       list znorms,
+                       DTYPE_F64_t[:,:] galc,
+                       DTYPE_F64_t[:,:] verc,
+                       object zgroups):
+    """
+    Description
+    ===========
+
+    Triangulate the zone boundary polygons of each void for visualization.
+
+    Each boundary polygon is split into a fan of triangles around its first
+    vertex.  A first pass counts the triangles so that the output arrays can
+    be allocated once, and a second pass fills them in.
+
+
+    Parameters
+    ==========
+
+    zverts : list of length N_zones
+        for each zone, a list of boundary polygons, each a list of vertex IDs
+
+    znorms : list of length N_zones
+        for each zone, a list of the [inside, outside] galaxy IDs across each
+        boundary polygon
+
+    galc : ndarray of shape (N_galaxies,3)
+        galaxy coordinates
+
+    verc : ndarray of shape (N_vertices,3)
+        Voronoi vertex coordinates
+
+    zgroups : iterable of length N_voids
+        for each void, the IDs of the zones that make it up
+
+
+    Returns
+    =======
+
+    tri1, tri2, tri3 : ndarrays of shape (N_triangles,3)
+        coordinates of the three corners of each triangle
+
+    norm : ndarray of shape (N_triangles,3)
+        unit normal of each triangle, pointing from the inside to the outside
+        galaxy
+
+    vid : ndarray of shape (N_triangles,)
+        void ID of each triangle
+    """
+
+    cdef ITYPE_t k, z, i, j, n_poly, idx, p0, p1, v0, v1, v2
+
+    cdef ITYPE_t num_tris = 0
+
+    cdef DTYPE_F64_t n_x, n_y, n_z, n_len
+
+    cdef list polys, norms, polids
+
+    ################################################################################
+    # First pass - count the triangles
+    ################################################################################
+    for v in zgroups:
+
+        for z in v:
+
+            for polids in zverts[z]:
+
+                num_tris += len(polids) - 2
+
+    tri1 = np.empty((num_tris, 3), dtype=np.float64)
+    tri2 = np.empty((num_tris, 3), dtype=np.float64)
+    tri3 = np.empty((num_tris, 3), dtype=np.float64)
+    norm = np.empty((num_tris, 3), dtype=np.float64)
+    vid = np.empty(num_tris, dtype=np.int64)
+
+    cdef DTYPE_F64_t[:,:] tri1_memview = tri1
+    cdef DTYPE_F64_t[:,:] tri2_memview = tri2
+    cdef DTYPE_F64_t[:,:] tri3_memview = tri3
+    cdef DTYPE_F64_t[:,:] norm_memview = norm
+    cdef DTYPE_INT64_t[:] vid_memview = vid
+
+    ################################################################################
+    # Second pass - fill in the triangles
+    ################################################################################
+    idx = 0
+
+    for k, v in enumerate(zgroups):
+
+        for z in v:
+
+            polys = zverts[z]
+
+            norms = znorms[z]
+
+            for i in range(len(polys)):
+
+                p0 = norms[i][0]
+                p1 = norms[i][1]
+
+                n_x = galc[p1,0] - galc[p0,0]
+                n_y = galc[p1,1] - galc[p0,1]
+                n_z = galc[p1,2] - galc[p0,2]
+
+                n_len = sqrt(n_x*n_x + n_y*n_y + n_z*n_z)
+
+                n_x = n_x/n_len
+                n_y = n_y/n_len
+                n_z = n_z/n_len
+
+                polids = polys[i]
+
+                n_poly = len(polids)
+
+                v0 = polids[0]
+
+                for j in range(1, n_poly - 1):
+
+                    v1 = polids[j]
+                    v2 = polids[j+1]
+
+                    tri1_memview[idx,0] = verc[v0,0]
+                    tri1_memview[idx,1] = verc[v0,1]
+                    tri1_memview[idx,2] = verc[v0,2]
+
+                    tri2_memview[idx,0] = verc[v1,0]
+                    tri2_memview[idx,1] = verc[v1,1]
+                    tri2_memview[idx,2] = verc[v1,2]
+
+                    tri3_memview[idx,0] = verc[v2,0]
+                    tri3_memview[idx,1] = verc[v2,1]
+                    tri3_memview[idx,2] = verc[v2,2]
+
+                    norm_memview[idx,0] = n_x
+                    norm_memview[idx,1] = n_y
+                    norm_memview[idx,2] = n_z
+
+                    vid_memview[idx] = k
+
+                    idx += 1
+
+    return tri1, tri2, tri3, norm, vid
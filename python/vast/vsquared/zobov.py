@@ -4,11 +4,14 @@
 import numpy as np
 import pickle
 import configparser
+from itertools import chain
 from scipy import stats
+from scipy.spatial import KDTree
 from astropy.table import Table
 
-from vast.vsquared.util import toSky, inSphere, wCen, getSMA, P, flatten
+from vast.vsquared.util import toSky, P, flatten
 from vast.vsquared.classes import Catalog, Tesselation, Zones, Voids
+from vast.vsquared._zobov_cython import build_tris
 
 class Zobov:
 
@@ -98,6 +101,9 @@ class Zobov:
             zones = pickle.load(open(self.intloc+"_zones.pkl",'rb'))
             voids = pickle.load(open(self.intloc+"_voids.pkl",'rb'))
         self.catalog = ctlg
+        # Indices of the galaxies that are their own nearest neighbor, i.e. the
+        # galaxies used in the tesselation
+        self._gcut = np.flatnonzero(self.catalog.nnls==np.arange(len(self.catalog.nnls)))
         if end>0:
             self.tesselation = tess
         if end>1:
@@ -186,11 +192,27 @@ class Zobov:
 
         vcuts = [list(flatten(self.zones.zcell[v])) for v in voids]
 
-        gcut  = np.arange(len(self.catalog.coord))[self.catalog.nnls==np.arange(len(self.catalog.nnls))]
-        cutco = self.catalog.coord[gcut]
+        cutco = self.catalog.coord[self._gcut]
+
+        # Flatten the cells of all voids, labelling each cell with its void
+        vlens = np.array([len(vcut) for vcut in vcuts],dtype=int)
+        cells = np.fromiter(chain.from_iterable(vcuts),dtype=int,count=np.sum(vlens))
+        vids  = np.repeat(np.arange(len(vcuts)),vlens)
+        cvols = self.tesselation.volumes[cells]
 
         # Build array of void volumes
-        vvols = np.array([np.sum(self.tesselation.volumes[vcut]) for vcut in vcuts])
+        vvols = np.bincount(vids,weights=cvols,minlength=len(vcuts))
+
+        # Volume-weighted centers of the voids
+        vcens = np.array([np.bincount(vids,weights=cvols*cutco[cells,i],minlength=len(vcuts)) for i in range(3)]).T/vvols.reshape(len(vvols),1)
+
+        # Moment of inertia tensors of the voids' tracers, for the ellipsoid fits
+        cc    = cutco[cells].T
+        iTens = np.zeros((len(vcuts),3,3))
+        for i in range(3):
+            j,k = (i+1)%3,(i+2)%3
+            iTens[:,i,i] = np.bincount(vids,weights=cc[j]**2.+cc[k]**2.,minlength=len(vcuts))
+            iTens[:,i,j] = iTens[:,j,i] = -np.bincount(vids,weights=cc[i]*cc[j],minlength=len(vcuts))
 
         # Calculate effective radius of voids
         vrads = (vvols*3/(4*np.pi))**(1/3)
@@ -203,44 +225,48 @@ class Zobov:
         
         voids = np.array(voids)[rcut]
 
-        vcuts = [vcuts[i] for i in np.arange(len(rcut))[rcut]]
+        iTens = iTens[rcut]
         vvols = vvols[rcut]
         vrads = vrads[rcut]
+        vcens = vcens[rcut]
         print('Removed voids smaller than', self.minrad, 'Mpc/h')
 
-        # Identify void centers.
-        print("Finding void centers...")
-        vcens = np.array([wCen(self.tesselation.volumes[vcut],cutco[vcut]) for vcut in vcuts])
         if method==0:
-            dcut  = np.array([64.*len(cutco[inSphere(vcens[i],vrads[i]/4.,cutco)])/vvols[i] for i in range(len(vrads))])<1./minvol
+            gtree = KDTree(cutco)
+            dcut  = 64.*gtree.query_ball_point(vcens,vrads/4.,return_length=True)/vvols<1./minvol
             vrads = vrads[dcut]
             rcut  = vrads>(minvol*dc)**(1./3)
             vrads = vrads[rcut]
             vcens = vcens[dcut][rcut]
             voids = (voids[dcut])[rcut]
+            iTens = iTens[dcut][rcut]
 
         # Identify eigenvectors of best-fit ellipsoid for each void.
         print("Calculating ellipsoid axes...")
 
-        vaxes = np.array([getSMA(vrads[i],cutco[vcuts[i]]) for i in range(len(vrads))])
+        eival,eivec = np.linalg.eig(iTens)
+        eival = eival**.25
+        rfac  = vrads/(np.prod(eival,axis=1)**(1./3))
+        eival = eival*rfac.reshape(len(rfac),1)
+        vaxes = eival.reshape(len(eival),3,1)*np.transpose(eivec,(0,2,1))
 
-        zvoid = [[-1,-1] for _ in range(len(self.zones.zvols))]
+        # For each zone, identify the smallest and largest voids containing it
+        # (the first such void in case of ties)
+        zvoid = -1*np.ones((len(self.zones.zvols),2),dtype=int)
 
-        for i in range(len(voids)):
-            for j in voids[i]:
-                if zvoid[j][0] > -0.5:
-                    if len(voids[i]) < len(voids[zvoid[j][0]]):
-                        zvoid[j][0] = i
-                    elif len(voids[i]) > len(voids[zvoid[j][1]]):
-                        zvoid[j][1] = i
-                else:
-                    zvoid[j][0] = i
-                    zvoid[j][1] = i
+        vlen  = np.array([len(v) for v in voids],dtype=int)
+        v_ids = np.repeat(np.arange(len(voids)),vlen)
+        z_ids = np.fromiter(chain.from_iterable(voids),dtype=int,count=np.sum(vlen))
+
+        for k,vl in enumerate([vlen[v_ids],-vlen[v_ids]]):
+            srt = np.lexsort((v_ids,vl,z_ids))
+            _,zfirst = np.unique(z_ids[srt],return_index=True)
+            zvoid[z_ids[srt[zfirst]],k] = v_ids[srt[zfirst]]
 
         self.vrads = vrads
         self.vcens = vcens
         self.vaxes = vaxes
-        self.zvoid = np.array(zvoid)
+        self.zvoid = zvoid
 
 
     def saveVoids(self):
@@ -281,25 +307,32 @@ class Zobov:
 
         ngal  = len(self.catalog.coord)
         glist = np.arange(ngal)
-        glut1 = glist[self.catalog.nnls==glist]
-        glut2 = [[] for _ in glut1]
+
+        # Map each galaxy to the cell of its nearest neighbor; self._gcut is
+        # sorted, so the cell is found by binary search
+        gcell = np.minimum(np.searchsorted(self._gcut,self.catalog.nnls),len(self._gcut)-1)
+        gin   = self._gcut[gcell]==self.catalog.nnls
+        gcell = gcell[gin]
+
         dlist = -1 * np.ones(ngal,dtype=int)
+        dlist[gin] = self.zones.depth[gcell]
 
-        for i,l in enumerate(glut2):
-            l.extend((glist[self.catalog.nnls==glut1[i]]).tolist())
-            dlist[l] = self.zones.depth[i]
+        # Map each cell to its zone
+        zcell = self.zones.zcell
+        zlens = np.fromiter(map(len,zcell),dtype=int,count=len(zcell))
+        czone = -1 * np.ones(len(self._gcut),dtype=int)
+        czone[np.fromiter(chain.from_iterable(zcell),dtype=int,count=np.sum(zlens))] = np.repeat(np.arange(len(zcell)),zlens)
 
         zlist = -1 * np.ones(ngal,dtype=int)
-        zcell = self.zones.zcell
+        zlist[gin] = czone[gcell]
 
         olist = 1-np.array(self.catalog.imsk,dtype=int)
         elist = np.zeros(ngal,dtype=int)
 
-        for i,cl in enumerate(zcell):
-            for c in cl:
-                zlist[glut2[c]] = i
-                if self.tesselation.volumes[c]==0. and not olist[glut2[c]].all():
-                    elist[glut2[c]] = 1
+        # Galaxies of zero-volume cells are on the edge, unless every galaxy
+        # of the cell is outside the mask
+        cedge = (self.tesselation.volumes==0.)*(czone>-1)*(np.bincount(gcell,weights=1-olist[gin],minlength=len(self._gcut))>0)
+        elist[gin] = cedge[gcell]
         elist[np.array(olist,dtype=bool)] = 0
 
         zT = Table([glist,zlist,dlist,elist,olist],names=('gal','zone','depth','edge','out'))
@@ -318,42 +351,39 @@ class Zobov:
             print("Sort voids first")
             return
 
-        galc = self.catalog.coord[self.catalog.nnls==np.arange(len(self.catalog.coord))]
-        gids = np.arange(len(self.catalog.coord))
-        gids = gids[self.catalog.nnls==gids]
+        galc = self.catalog.coord[self._gcut]
+        gids = self._gcut
         g2v = -1*np.ones(len(self.catalog.coord),dtype=int)
         g2v2 = -1*np.ones(len(self.catalog.coord),dtype=int)
         verc = self.tesselation.verts
         zverts = self.zones.zverts
         znorms = self.zones.znorms
         z2v = self.zvoid.T[1]
-        z2v2 = np.array([np.where(z2v==z2)[0] for z2 in np.unique(z2v[z2v!=-1])])
-        zcut = [np.product([np.product(self.tesselation.volumes[self.zones.zcell[z]])>0 for z in z2])>0 for z2 in z2v2]
+        # Group the zones by void: sort the zone IDs by void, then split at the
+        # first zone of each void
+        zids = np.flatnonzero(z2v!=-1)
+        zids = zids[np.argsort(z2v[zids],kind='stable')]
+        _,zstart = np.unique(z2v[zids],return_index=True)
+
+        # Flag zones with a zero-volume cell, then drop voids with a flagged zone
+        zcell = self.zones.zcell
+        zlens = np.fromiter(map(len,zcell),dtype=int,count=len(zcell))
+        cells = np.fromiter(chain.from_iterable(zcell),dtype=int,count=np.sum(zlens))
+        zedge = np.logical_or.reduceat(self.tesselation.volumes[cells]==0.,np.cumsum(zlens)-zlens)
+        zcut  = ~np.logical_or.reduceat(zedge[zids],zstart)
+        z2v2  = [z2 for z2,zc in zip(np.split(zids,zstart[1:]),zcut) if zc]
 
-        tri1 = []
-        tri2 = []
-        tri3 = []
-        norm = []
-        vid  = []
+        tri1,tri2,tri3,norm,vid = build_tris(zverts,znorms,galc,verc,z2v2)
 
-        for k,v in enumerate(z2v2[zcut]):
+        for k,v in enumerate(z2v2):
             for z in v:
-                for i in range(len(znorms[z])):
-                    p = znorms[z][i]
-                    n = galc[p[1]] - galc[p[0]]
-                    n = n/np.sqrt(np.sum(n**2.))
-                    polids = zverts[z][i]
-                    trids = [[polids[0],polids[j],polids[j+1]] for j in range(1,len(polids)-1)]
-                    for t in trids:
-                        tri1.append(verc[t[0]])
-                        tri2.append(verc[t[1]])
-                        tri3.append(verc[t[2]])
-                        norm.append(n)
-                        vid.append(k)
+                for p in znorms[z]:
                     g2v[gids[p[0]]] = k
-        for k,v in enumerate(z2v2[zcut]):
+        # Second pass, once g2v is complete: the outer galaxy of a boundary
+        # may belong to a void that is visited later
+        for k,v in enumerate(z2v2):
             for z in v:
-                for i in range(len(znorms[z])):
+                for p in znorms[z]:
                     if g2v[gids[p[1]]] != -1:
                         g2v2[gids[p[1]]] = k
 
@@ -361,11 +391,10 @@ class Zobov:
             print("Error: largest void found encompasses entire survey (try using a method other than 1 or 2)")
             return
 
-        tri1 = np.array(tri1).T
-        tri2 = np.array(tri2).T
-        tri3 = np.array(tri3).T
-        norm = np.array(norm).T
-        vid = np.array(vid)
+        tri1 = tri1.T
+        tri2 = tri2.T
+        tri3 = tri3.T
+        norm = norm.T
 
         vizT = Table([vid,norm[0],norm[1],norm[2],tri1[0],tri1[1],tri1[2],tri2[0],tri2[1],tri2[2],tri3[0],tri3[1],tri3[2]],
                      names=('void_id','n_x','n_y','n_z','p1_x','p1_y','p1_z','p2_x','p2_y','p2_z','p3_x','p3_y','p3_z'))
@@ -61,7 +61,7 @@ class build_ext(_build_ext):
 # Identify all Cython extensions and add them to the extensions list.
 #
 ext_modules = []
-extfiles = glob('python/vast/voidfinder/*.pyx') + glob('python/vast/voidfinder/*/*.pyx')
+extfiles = glob('python/vast/voidfinder/*.pyx') + glob('python/vast/voidfinder/*/*.pyx') + glob('python/vast/vsquared/*.pyx')
 for extfile in extfiles:
     name = name = extfile.replace('python/', '').replace('/', '.').replace('.pyx', '')
     ext_modules.append(Extension(name, [extfile], library_dirs=['m'], cython_directives = {'embedsignature': True}))